@@ -1,7 +1,6 @@
 #! {/}
-import json
 from glob import glob
-from msp_tables import prepare_tables, read_mspaths_csvs, column_pairs
+from msp_tables import prepare_tables, read_mspaths_csvs, column_pairs, load_column_names
 
 
 def main():
@@ -22,8 +21,7 @@ def main():
 
     args = parser.parse_args()
 
-    with open("column_names.json", "r") as file:
-        table_data = json.load(file)
+    table_data = load_column_names()
 
     for tablename, pairs in table_data.items:
         df = read_mspaths_csvs(args.mspaths_dir, tablename, mpis)
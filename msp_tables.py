@@ -1,10 +1,14 @@
+import os
 import json
 import logging
+import numpy as np
 import pandas as pd
 from glob import glob
 from rich import print
 from rich.progress import track
 from rich.logging import RichHandler
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, abspath,basename, exists
 
 __author__ = "Paul Kuntke"
@@ -23,6 +27,9 @@ participants.tsv for further use
 
 """
 
+# low-cardinality columns that are stored as pandas categoricals
+CATEGORICAL_COLUMNS = ('mpi', 'site', 'sex', 'study_id')
+
 FORMAT = "%(message)s"
 logging.basicConfig(
     level="DEBUG", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
@@ -30,15 +37,50 @@ logging.basicConfig(
 log = logging.getLogger("rich")
 
 
+@lru_cache(maxsize=None)
+def _scan_ids(bids_dir):
+    if not exists(bids_dir):
+        log.debug(f"query {bids_dir} => directory does not exist")
+        return ()
+    patlist = tuple(e.name[4:] for e in os.scandir(bids_dir) if e.name.startswith('sub-') and e.is_dir())
+    log.debug(f"query {bids_dir} => found mpis: {list(patlist)}")
+    return patlist
+
+@lru_cache(maxsize=1)
+def load_column_names(path:str="column_names.json"):
+    """
+    Load the table definitions (tablename => column pairs), parsed only once per process
+    """
+    with open(path, "r") as file:
+        return json.load(file)
+
 def get_ids(bids_dir):
     """
     Find all subject-ids from bids-dir
+
+    The directory is only scanned once per process (cached by its absolute path)
     """
-    patlist = [p.replace('sub-','').split('/')[-1] for p in glob(join(bids_dir, 'sub-*'))]
-    log.debug(f"query {bids_dir} => found mpis: {patlist}")
-    return patlist
+    return list(_scan_ids(abspath(bids_dir)))
 
-def read_mspaths_csvs(basedir:str, table:str,  subjects:list[str]|None = None):
+def _read_csv(f:str, columns:set[str]|None = None):
+    """
+    Read a single datacut-csv and remember its filename in column 'file'
+
+    If columns is given only those (that exist in this datacut) are parsed
+    """
+    log.debug(f"reading {f} ")
+    usecols = None
+    if columns is not None:
+        # the datacuts differ in their columns => select from the header of this file
+        header = pd.read_csv(f, encoding="cp1252", nrows=0).columns
+        usecols = [c for c in header if c in columns]
+    # Some tables contain Chars that are not readable with default utf-8 codepage
+    # mpi ends up as str (pyarrow still infers it as int first, so leading zeros are not kept)
+    f_df = pd.read_csv(f, encoding="cp1252", engine="pyarrow", dtype={"mpi": str}, usecols=usecols)
+    f_df['file'] = basename(f)
+    return f_df
+
+def read_mspaths_csvs(basedir:str, table:str,  subjects:list[str]|None = None, columns:list[str]|None = None):
     """
     Read original tables from mspaths-csvs
 
@@ -55,6 +97,8 @@ def read_mspaths_csvs(basedir:str, table:str,  subjects:list[str]|None = None):
             Select one table within basedir
         subjects: list or None
             Select SubjectIDs from Tables, if None all will be selected, default: None
+        columns: list or None
+            Only read these columns ('mpi' is always read), if None all will be read, default: None
             
     """
     filelist = glob(join(abspath(basedir), table, '*_v0*.csv'))
@@ -69,20 +113,22 @@ def read_mspaths_csvs(basedir:str, table:str,  subjects:list[str]|None = None):
 
     df = pd.DataFrame({"mpi":[]})
     if len(filelist) > 0:
-        for f in filelist:
-            log.debug(f"reading {f} ")
-            f_df = pd.read_csv(f, encoding="cp1252") # Some tables contain Chars that are not readable with default utf-8 codepage
-            f_df['file'] = basename(f)
-            df = pd.concat((df, f_df), ignore_index = True)
-            
-        # now change Filetype of MPI to str
-        df.mpi = df.mpi.astype(str)
+        # the datacuts are independent files => read them concurrently
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            frames = list(executor.map(partial(_read_csv, columns=None if columns is None else set(columns) | {'mpi'}), filelist))
+        # concat once - growing df inside the loop copies all previous rows on every file
+        df = pd.concat(frames, ignore_index = True)
+
+        # ids/labels repeat a lot => categorical keeps one value per id and compares by int-codes
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
 
         if subjects is None:
             log.info("No subject selected - use all subjects")
         else:
             log.debug("filtering mpis")
-            df = df.query("mpi in @subjects")
+            df = df[df['mpi'].isin(set(subjects))]
     else: 
         log.debug(f"Empty filelist - skipping")
 
@@ -90,6 +136,26 @@ def read_mspaths_csvs(basedir:str, table:str,  subjects:list[str]|None = None):
     return df
 
 
+def year_from_timestamp(seconds:pd.Series):
+    """
+    Get the calendar year of unix-timestamps (seconds) in one numpy pass
+
+    Parameters
+    ----------
+    seconds: pandas Series
+        unix-timestamps, missing values are allowed
+
+    Returns
+    -------
+        numpy array (float) of years, NaN where the timestamp is missing
+    """
+    secs = seconds.to_numpy(dtype='float64', na_value=np.nan)
+    missing = np.isnan(secs)
+    years = np.where(missing, 0, secs).astype('datetime64[s]').astype('datetime64[Y]').astype('float64') + 1970
+    years[missing] = np.nan
+    return years
+
+
 def column_pairs(df:pd.DataFrame, column_pairs:list):
     """
     Some of the columns have changed their Names over the different dataset-versions (v001..v017)
@@ -109,19 +175,25 @@ def column_pairs(df:pd.DataFrame, column_pairs:list):
         The column_pairs
 
     """
+    drop_cols = []
     for pair in column_pairs:
-        for col in pair[1:]:
-            # Fill in empty cells with values from other cols from the pairs
-            try: 
-                df[pair[0]] = df[pair[0]].fillna(df[col])
-                df.drop(columns=col, inplace=True)
-            except KeyError:
-                continue
+        if pair[0] not in df.columns:
+            continue
+        cols = [col for col in pair if col in df.columns]
+        if len(cols) < 2:
+            continue
+        # Fill in empty cells with values from other cols from the pairs - first non-null value per row
+        df[pair[0]] = df[cols].bfill(axis=1).iloc[:, 0].infer_objects()
+        drop_cols.extend(cols[1:])
+
+    # drop all merged columns at once
+    if len(drop_cols) > 0:
+        df.drop(columns=drop_cols, inplace=True)
 
     return df
 
 
-def prepare_tables(mspaths_dir, bidsdir, tables, all_mpis:bool=False):
+def prepare_tables(mspaths_dir, bidsdir, tables, all_mpis:bool=False, columns:dict|None=None):
     """
     Collect all tables: put datacuts together into single tables, remove double entries
 
@@ -143,6 +215,9 @@ def prepare_tables(mspaths_dir, bidsdir, tables, all_mpis:bool=False):
 
     all_mpis: bool
         Set to true if you don't want to filter out MPIS from bids-dataset
+    columns: dictionary or None
+        key: tablename, value: list of colnames to read (the names of the pairs are added),
+        tables without key and None read all columns. Note: the written csvs only contain these columns
     """
 
     mpis = get_ids(bidsdir) if not all_mpis else None
@@ -150,7 +225,10 @@ def prepare_tables(mspaths_dir, bidsdir, tables, all_mpis:bool=False):
     prepared = {}
 
     for tablename, pairs in tables.items():
-        df = read_mspaths_csvs(mspaths_dir, tablename, mpis)
+        table_columns = None
+        if columns is not None and tablename in columns:
+            table_columns = list(columns[tablename]) + [col for pair in pairs for col in pair]
+        df = read_mspaths_csvs(mspaths_dir, tablename, mpis, table_columns)
         df = column_pairs(df, pairs)
 
         
@@ -164,7 +242,34 @@ def prepare_tables(mspaths_dir, bidsdir, tables, all_mpis:bool=False):
 
 
 
-def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None):
+def clear_values(df:pd.DataFrame, column:str, mpis:set|None = None):
+    """
+    Get the value of column for every mpi that has exactly one distinct (non-null) value in it
+
+    Parameters
+    ----------
+    df: pandas DataFrame
+        table with columns 'mpi' and column
+    column: str
+        column to check (e.g. 'sex', 'site')
+    mpis: set or None
+        only keep these mpis, if None all will be kept
+
+    Returns
+    -------
+        DataFrame indexed by mpi with the single column
+    """
+    entries = df.dropna(subset=column)
+    counts = entries.groupby('mpi', observed=True)[column].nunique() # number of distinct values per mpi
+    indifferent_mpis = counts.index[counts > 1]
+    first = entries.drop_duplicates(subset='mpi').set_index('mpi')[[column]]
+    mask = ~first.index.isin(indifferent_mpis)
+    if mpis is not None:
+        mask &= first.index.isin(mpis)
+    return first[mask]
+
+
+def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None, prepared_tables:dict|None = None):
     """
         - age(at baseline),
         - sex 
@@ -183,13 +288,14 @@ def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None):
         Path to output-bids dir (root)
     group: str
         should be "patients" or "controls", if None it will be detetected by StudyID (001 => patients, 005 => controls)
+    prepared_tables: dict or None
+        result of prepare_tables, if None the tables are prepared from column_names.json
     """
     
-    with open("column_names.json", "r") as file:
-        table_data = json.load(file)
-    
     mpis = get_ids(bidsdir) # get all MSP-IDs from the BIDS-Dataset
-    prepared_tables = prepare_tables(mspaths_dir, bidsdir, table_data)
+    mpi_set = set(mpis)
+    if prepared_tables is None:
+        prepared_tables = prepare_tables(mspaths_dir, bidsdir, load_column_names())
 
     # Sex can be fetched from EMR and MSPT Sociodemoigraphics => both are incomplete so we combine them to get the maximum amount
     try:
@@ -209,17 +315,10 @@ def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None):
     df.sex = df.sex.str.lower() # the tables are inconsistent in the use of caps
     df.sex.replace('undifferentiated', pd.NaT) #  some people have different entries in sex => remove the undifferentiated to get entries for those patients who
                                                    # have only                                                
-    grouped_df = df.dropna(subset='sex').groupby('mpi').agg({'sex': 'unique'})
-    indifferent_sex_mpis = grouped_df[pd.DataFrame(grouped_df).apply(lambda x: len(x.sex), axis=1) > 1].index.to_list()
-    mpis_with_clear_sex = pd.DataFrame(grouped_df.query('mpi not in @indifferent_sex_mpis').sex.map(lambda x: x[0]))
-    sex_df = mpis_with_clear_sex.query('mpi in @mpis')
-
-    grouped_df = df.dropna(subset='site').groupby('mpi').agg({'site': 'unique'}, skipna=True)
-    indifferent_site_mpis = grouped_df[pd.DataFrame(grouped_df).apply(lambda x: len(x.site), axis=1) > 1].index.to_list()
-    mpis_with_clear_site = pd.DataFrame(grouped_df.query('mpi not in @indifferent_site_mpis').site.map(lambda x: x[0]))
-    site_df = mpis_with_clear_site.query('mpi in @mpis')
-    results_df = pd.merge(sex_df, site_df, on='mpi', how='outer')
-    results_df = results_df.merge(pd.DataFrame({'mpi': mpis}), on='mpi', how='right')
+    sex_df = clear_values(df, 'sex', mpi_set)
+    site_df = clear_values(df, 'site', mpi_set)
+    # both are indexed by mpi => align them on the mpis of the BIDS-Dataset without a merge
+    results_df = sex_df.join(site_df, how='outer').reindex(pd.Index(mpis, name='mpi')).reset_index()
 
 
     
@@ -230,19 +329,18 @@ def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None):
     # df["date"] = pd.to_datetime(df.effective_date, unit='s')
 
     if "effective_date" in df.columns:
-        df["date"] = pd.to_datetime(df.effective_date, unit='s')
+        year = year_from_timestamp(df.effective_date)
     elif "nm_strt" in df.columns:
-        df["date"] = pd.to_datetime(df.nm_strt, unit='s')
+        year = year_from_timestamp(df.nm_strt)
     else:
         from ipdb import set_trace
         set_trace()    
-    df["birthyear"] = df.date.dt.year - df.age
-    df["birthyear"] = df.birthyear.round(0)
+    df["birthyear"] = (year - df.age.to_numpy(dtype='float64', na_value=np.nan)).round(0)
 
-    results_df = results_df.merge(pd.DataFrame(df.groupby('mpi').agg({'birthyear': lambda x: round(x.median())})), on='mpi', how='left')
+    results_df = results_df.merge(df.groupby('mpi', observed=True)['birthyear'].median().round().astype('Int64').to_frame(), on='mpi', how='left')
     # Narrow down the data set to known MPIs
 
-    results_df = pd.DataFrame(results_df.query("mpi in @all_mpis"))
+    results_df = pd.DataFrame(results_df[results_df['mpi'].isin(set(all_mpis))])
     # Now add the Group - patients/controls => based on automatic guess or given as parameter
     if group is None:
         if "888MS001" in mspaths_dir:
@@ -260,13 +358,8 @@ def create_participants_tsv(mspaths_dir, bidsdir, group:str|None = None):
 
 def main(mspaths_dir, bidsdir, overwrite_participants_tsv:bool=False):
 
-    with open("column_names.json", "r") as file:
-
-        table_data = json.load(file)
-
-    
-    prepare_tables(mspaths_dir, bidsdir, table_data)
-    participants_df = create_participants_tsv(mspaths_dir, bidsdir)
+    prepared_tables = prepare_tables(mspaths_dir, bidsdir, load_column_names())
+    participants_df = create_participants_tsv(mspaths_dir, bidsdir, prepared_tables=prepared_tables)
 
     file_path = join(bidsdir, 'participants.tsv')
     if overwrite_participants_tsv:
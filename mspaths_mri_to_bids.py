@@ -1,21 +1,55 @@
 #! /usr/bin/env python3
 
+import os
 import shutil
 import zipfile
 import logging
 import datetime
 import subprocess
+from contextlib import contextmanager
 import pandas as pd
 from glob import glob
 from rich import print
-from os import makedirs, rename
+from os import makedirs, rename, link
 from rich.logging import RichHandler
-from os.path import join, abspath, exists, basename
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import join, abspath, exists, basename, dirname
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn
 
 
 
+# Use SIMD-accelerated inflate (python-isal) for the DICOM bundles if available
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+
+@contextmanager
+def _fast_inflate():
+    """
+    Let zipfile inflate deflated entries with isal_zlib while in this context.
+    Only the decompressor is swapped (and restored afterwards) - compression is untouched
+    """
+    if isal_zlib is None:
+        yield
+        return
+    get_decompressor = zipfile._get_decompressor
+
+    def _get_isal_decompressor(compress_type):
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return isal_zlib.decompressobj(-15)
+        return get_decompressor(compress_type)
+
+    zipfile._get_decompressor = _get_isal_decompressor
+    try:
+        yield
+    finally:
+        zipfile._get_decompressor = get_decompressor
+
+
 __tmpdir="/tmp/mspaths_to_bids/"
+__copy_bufsize = 4 * 1024 * 1024
 
 ### Setup Logging
 FORMAT = "%(message)s"
@@ -25,7 +59,81 @@ logging.basicConfig(
 log = logging.getLogger("rich")
 
 
-def extract_bundle(path, bidsroot, tmpdir=__tmpdir, skip_processed=True, progress=None, task=None):
+def _fast_move(src, dst, bufsize=__copy_bufsize):
+    """
+    Move src to dst. Tries rename (same filesystem), then a hardlink and
+    falls back to a buffered copy if tmpdir and bidsroot are on different filesystems
+    """
+    try:
+        rename(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, length=bufsize)
+
+
+def load_processed_zipfiles():
+    """
+    Read the set of already processed zipfiles from 'processed_zipfiles.csv'
+    """
+    if not exists('processed_zipfiles.csv'):
+        return set()
+    with open('processed_zipfiles.csv') as file:
+        return set(line.rstrip() for line in file)
+
+
+def _convert_session(f, bidsroot, path):
+    """
+    Convert a single extracted session-dir with dcm2niix and move FLAIR/T1w into bidsroot
+
+    Parameters
+    ----------
+    f: str
+        extracted session-dir (<tmpdir>/<..._subject>/<session>)
+    bidsroot: str
+        root of BIDS-Dataset
+    path: str
+        zipfile the session was extracted from (for logging)
+    """
+    try:
+        subject = basename(dirname(f)).split('_')[1]
+        session = basename(f)
+    except:
+        log.error(f'unkown file {f} in zipfile {path}. Could not extract subject/session from filename. Skipping')
+        return
+    log.info(f'converting subject {subject} , session {session}')
+    result = subprocess.run(['/usr/bin/dcm2niix', '-z', 'y', '-b', 'y', '-o',f ,f], capture_output=True)
+   
+    # Now copy the files to the bids-dir
+    flair_file = glob(join(f,'*FLAIR*MS-P*.nii.gz')) # Identify FLAIR-File
+    t1_file = glob(join(f, '*T1*MS-P*.nii.gz')) # Identify T1w File
+
+    niftis = list(dict.fromkeys(flair_file + t1_file)) # files are moved => each only once
+    if len(niftis) == 0:
+        return
+
+    target_dir = join(bidsroot, f'sub-{subject}', f'ses-{session}', 'anat' )
+    makedirs(target_dir, exist_ok=True) # other sessions of this subject may create sub-dir concurrently
+
+    for nifti in niftis:
+        sidecar = nifti.replace('.nii.gz', '.json')
+        modality = "FLAIR" if "FLAIR" in nifti else "T1w"
+        target_file = f'sub-{subject}_ses-{session}_{modality}'
+
+        _fast_move(nifti, join(target_dir, f'{target_file}.nii.gz'))
+        try:
+            _fast_move(sidecar, join(target_dir, f'{target_file}.json'))
+        except FileNotFoundError:
+            log.error(f'Sidecar {sidecar} does not exist. Extracted from {path}')
+
+
+def extract_bundle(path, bidsroot, tmpdir=__tmpdir, skip_processed=True, progress=None, task=None, processed=None):
     """
     Extract a single bundle-file
 
@@ -35,20 +143,22 @@ def extract_bundle(path, bidsroot, tmpdir=__tmpdir, skip_processed=True, progres
         full filename of zipfile
     skip_processed: bool
         Skip this file if it was done before (see 'files_processed.csv')
+    processed: set or None
+        already processed zipfiles (see load_processed_zipfiles), will be updated
+        with path. If None 'processed_zipfiles.csv' is read
 
     Returns
     -------
         list of extracted dicoms
     """
 
-    if skip_processed and exists('processed_zipfiles.csv'):
-        with open('processed_zipfiles.csv') as file:
-            lines = [line.rstrip() for line in file]
-            
-            # Skip this file if already processed
-            if path in lines:
-                log.info(f'Already processed {path}. Skipping')
-                return []
+    if processed is None:
+        processed = load_processed_zipfiles()
+
+    # Skip this file if already processed
+    if skip_processed and path in processed:
+        log.info(f'Already processed {path}. Skipping')
+        return []
 
     if exists(tmpdir):
         # Clear the directory
@@ -60,50 +170,42 @@ def extract_bundle(path, bidsroot, tmpdir=__tmpdir, skip_processed=True, progres
         makedirs(tmpdir)
         log.info(f"Created the directory: {tmpdir}")
 
+    # Stream the entries to <tmpdir>/<..._subject>/<session>/... and remember the
+    # session-dirs on the way, so there is no need to glob the tmpdir afterwards
+    sessions = {}
+    created_dirs = set()
     try:
-        with zipfile.ZipFile(path,"r") as zip_ref:
-            zip_ref.extractall(tmpdir)
+        with _fast_inflate(), zipfile.ZipFile(path,"r") as zip_ref:
+            for info in zip_ref.infolist():
+                parts = info.filename.split('/')
+                if info.is_dir() or len(parts) < 3 or parts[0] == '' or '..' in parts:
+                    continue
+                target = join(tmpdir, *parts)
+                if dirname(target) not in created_dirs:
+                    makedirs(dirname(target), exist_ok=True)
+                    created_dirs.add(dirname(target))
+                with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=__copy_bufsize)
+                sessions[join(tmpdir, parts[0], parts[1])] = None
     except:
         log.error(f"Could not extract {path}")
         return []
 
-    filelist = glob(join(tmpdir, '*', '*'))
+    filelist = list(sessions)
     print(f'extracted files from {path}')
     if not progress is None:
         progress.update(task, total=len(filelist), completed=0)
         progress.start_task(task)
-    for f in filelist:
-        try:
-            subject = f.split('/')[-2].split('_')[1]
-            session = f.split('/')[-1]
-        except:
-            log.error(f'unkown file {f} in zipfile {path}. Could not extract subject/session from filename. Skipping')
-            continue
-        log.info(f'converting subject {subject} , session {session}')
-        result = subprocess.run(['/usr/bin/dcm2niix', '-z', 'y', '-b', 'y', '-o',f ,f], capture_output=True)
-       
-        # Now copy the files to the bids-dir
-        flair_file = glob(join(f,'*FLAIR*MS-P*.nii.gz')) # Identify FLAIR-File
-        t1_file = glob(join(f, '*T1*MS-P*.nii.gz')) # Identify T1w File
-
-        for nifti in flair_file + t1_file:
-            sidecar = nifti.replace('.nii.gz', '.json')
-            modality = "FLAIR" if "FLAIR" in nifti else "T1w"
-            target_file = f'sub-{subject}_ses-{session}_{modality}'
-            target_dir = join(bidsroot, f'sub-{subject}', f'ses-{session}', 'anat' )
-            if not exists(target_dir):
-                makedirs(target_dir)
-
-            shutil.copy(nifti, join(target_dir, f'{target_file}.nii.gz'))
-            if exists(sidecar):
-                shutil.copy(sidecar, join(target_dir, f'{target_file}.json'))
-            else:
-                log.error(f'Sidecar {sidecar} does not exist. Extracted from {path}')
-
-        if not progress is None:
-            progress.update(task, advance=1)
+    # sessions are independent => run dcm2niix for several sessions at once
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_convert_session, f, bidsroot, path) for f in filelist]
+        for future in as_completed(futures):
+            future.result() # re-raise errors of the worker
+            if not progress is None:
+                progress.update(task, advance=1)
         
     # Write Name of finally processed file to list
+    processed.add(path)
     with open('processed_zipfiles.csv', 'a') as f:
         f.write(f'{path}\n')
 
@@ -127,12 +229,13 @@ def extract_mri_files(source, bidsroot):
     ) as progress:
         zipfile_task = progress.add_task("[red]Extracting Zipfiles...", total=len(dicom_zips))
         dicom_task = progress.add_task("[dodger_blue1]Processing DICOMS", total=None)
+        processed = load_processed_zipfiles()
         for zipfile in dicom_zips:
             log.debug(f'Starting to extract files from {zipfile}')
             
             progress.update(zipfile_task, advance=1, description=f"[red]Extracting Zipfile [yellow]{basename(zipfile)}")
             progress.reset(dicom_task)
-            extract_bundle(zipfile, abspath(bidsroot), progress=progress, task=dicom_task)
+            extract_bundle(zipfile, abspath(bidsroot), progress=progress, task=dicom_task, processed=processed)
 
 def extract_single_zipbundle(source, bidsroot):
      with Progress(
@@ -147,10 +250,28 @@ def extract_single_zipbundle(source, bidsroot):
 
 
 
+def _session_files(session_dir, session):
+    """
+    List files sub*ses-<session>* in the datatype-dirs (anat, ...) of session_dir
+    """
+    try:
+        datatype_dirs = [e.path for e in os.scandir(session_dir) if not e.name.startswith('.') and e.is_dir()]
+    except FileNotFoundError:
+        return []
+    files = []
+    for d in datatype_dirs:
+        files.extend(e.path for e in os.scandir(d) if e.name.startswith('sub') and f'ses-{session}' in e.name[3:])
+    return files
+
+
 def cleanup_sessions(bidsroot, dryrun:bool=False):
 
     log.info(f'Finding all subjects in bidsdir {bidsroot}')
-    subjects = glob(join(abspath(bidsroot), 'sub-*'))
+    subjects = []
+    if exists(bidsroot):
+        subjects = [e.path for e in os.scandir(abspath(bidsroot)) if e.name.startswith('sub-') and e.is_dir()]
+    else:
+        log.warning(f'bidsdir {bidsroot} does not exist - nothing to clean up')
 
     with Progress(
         SpinnerColumn(),
@@ -162,7 +283,7 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
 
         for subject in subjects:
             subject_id = basename(subject)
-            sessions = [basename(s).replace('ses-','') for s in glob(join(subject, 'ses-*'))]
+            sessions = [e.name[4:] for e in os.scandir(subject) if e.name.startswith('ses-')]
             sessions.sort(reverse=False)
 
             
@@ -171,6 +292,11 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
             if exists(sessions_tsv):
                 log.info(f'session_tsv for {subject_id} already found, checking if I need to append')
                 sessions_df = pd.read_csv(sessions_tsv, header=0, sep='\t')
+            # collect rows as dicts and build the DataFrame once after the loop
+            session_rows = sessions_df.to_dict('records')
+            # hashed lookups for the membership tests below, kept in sync with session_rows
+            session_ids = set(r['session_id'] for r in session_rows)
+            session_dates = set((r['session_id'], r['acq_time']) for r in session_rows)
 
             for s in range(len(sessions)):
 
@@ -181,9 +307,9 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
                     continue
 
                 ses_id = f'ses-{s+1:03}'
-                if ses_id in sessions_df.session_id.to_list():
+                if ses_id in session_ids:
                     # There's already a session with this ID:
-                    if ses_date in sessions_df.query('session_id == @ses_id').acq_time.to_list():
+                    if (ses_id, ses_date) in session_dates:
                         # This session is already in the list => ignore
                         log.debug(f'{subject}: session {ses_id} with date {ses_date} is already in sessions.tsv')
                         continue
@@ -191,12 +317,14 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
                         # Theres already a session of the same name - but different date - find a new name
                         log.debug(f'{subject}: session {ses_id} is already in sessions.tsv - searching new session-id')
                         ses_nr = s
-                        while ses_id in sessions_df.session_id.to_list():
+                        while ses_id in session_ids:
                             ses_nr = ses_nr + 1
                             ses_id = f'ses-{ses_nr+1:03}'
                         log.debug(f'{subject}: new session_id found: {ses_id}')
 
-                sessions_df = pd.concat((sessions_df, pd.DataFrame({'session_id': [ses_id], 'acq_time': [ses_date]})), ignore_index=True)
+                session_rows.append({'session_id': ses_id, 'acq_time': ses_date})
+                session_ids.add(ses_id)
+                session_dates.add((ses_id, ses_date))
                 log.debug(f'renaming ses-{sessions[s]} to ses-{s+1:03}')
 
                 if dryrun:
@@ -205,7 +333,7 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
                     log.info(f'renaming session: {sessions[s]} to {s+1:03}')
                     rename(join(subject, f'ses-{sessions[s]}'), join(subject, f'ses-{s+1:03}'))
 
-                files = glob(join(subject, ses_id, '*', f'sub*ses-{sessions[s]}*'))
+                files = _session_files(join(subject, ses_id), sessions[s])
                 for f in files:
                     new_f = f.replace(f"ses-{sessions[s]}", ses_id)
                     if dryrun:
@@ -213,6 +341,7 @@ def cleanup_sessions(bidsroot, dryrun:bool=False):
                     else:
                         log.info(f'renaming {f} to {new_f}')
                         rename(f, new_f)
+            sessions_df = pd.DataFrame(session_rows, columns=list(dict.fromkeys([*sessions_df.columns, 'session_id', 'acq_time'])))
             # Write the sessions_tsv
 
             sessions_tsv = join(subject, f'{subject_id}_sessions.tsv')
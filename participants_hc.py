@@ -7,13 +7,13 @@
 # mpi, sex, site, birhtyear, group
 
 
-import json
+import numpy as np
 import pandas as pd
 from glob import glob
 from os.path import join, abspath
 from argparse import ArgumentParser
 from rich.progress import track
-from msp_tables import prepare_tables, get_ids
+from msp_tables import prepare_tables, get_ids, year_from_timestamp, load_column_names
 from rich.logging import RichHandler
 import logging
 
@@ -39,15 +39,11 @@ def main(bidspath:str, mspaths_dir:str):
     # First get a list of all MPIS in the Dataset
     mpis = get_ids(bidspath)
 
-    with open("column_names.json", "r") as file:
-        table_data = json.load(file)
-    
-    prepared_tables = prepare_tables(mspaths_dir, bidspath, table_data)
+    prepared_tables = prepare_tables(mspaths_dir, bidspath, load_column_names())
     
     
     df = prepared_tables["MSPT Sociodemographics"]
-    df["mpi"] = df["mpi"].astype(str)
-    df = pd.DataFrame(df.query('mpi in @mpis and study_id==5')[['mpi', 'site', 'sex']])
+    df = pd.DataFrame(df[df['mpi'].isin(set(mpis)) & (df['study_id'] == 5)][['mpi', 'site', 'sex']])
 
     import ipdb; ipdb.set_trace()
 
@@ -55,10 +51,10 @@ def main(bidspath:str, mspaths_dir:str):
     
     mpis = df.mpi.to_list()
     log.debug(mpis)
-    df_age = prepared_tables["Social History"].query('mpi in @mpis')[['mpi','nm_strt', 'age']]
-    df_age['date'] = pd.to_datetime(df_age["nm_strt"], unit='s')
-    df_age['birthyear'] = df_age.date.dt.year - df_age.age
-    df_age = df_age.groupby('mpi').agg({'birthyear': lambda x: round(x.median())})
+    df_age = prepared_tables["Social History"]
+    df_age = df_age[df_age['mpi'].isin(set(mpis))][['mpi','nm_strt', 'age']]
+    df_age['birthyear'] = year_from_timestamp(df_age["nm_strt"]) - df_age.age.to_numpy(dtype='float64', na_value=np.nan)
+    df_age = df_age.groupby('mpi', observed=True)['birthyear'].median().round().astype('Int64').to_frame()
     df = pd.merge(df, df_age, on='mpi', how='left')
 
     df.to_csv(join(bidspath, 'participants_hc.tsv'), sep='\t', index=False)